@@ -5,6 +5,7 @@ ATAC-seq pipeline
 """
 
 from argparse import ArgumentParser
+import errno
 import os
 import sys
 from . import toolkit as tk
@@ -34,14 +35,19 @@ def main():
     samplePickle = args.samplePickle
 
     # Read in objects
-    prj, sample, args = pickle.load(open(samplePickle, "rb"))
+    with open(samplePickle, "rb", 1024 * 1024) as handle:
+        prj, sample, args = pickle.load(handle)
 
     # Start main function
     process(args, prj, sample)
 
     # Remove pickle
     if not args.dry_run:
-        os.system("rm %s" % samplePickle)
+        try:
+            os.unlink(samplePickle)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
     # Exit
     print("Finished and exiting.")
@@ -75,7 +81,7 @@ def process(args, prj, sample):
     pipe = Pypiper("pipe", sample.dirs.sampleRoot, args=args)
 
     # Merge Bam files if more than one technical replicate
-    if type(sample.unmappedBam) == list:
+    if isinstance(sample.unmappedBam, (list, tuple)):
         pipe.timestamp("Merging bam files from replicates")
         cmd = tk.mergeBams(
             inputBams=sample.unmappedBam,  # this is a list of sample paths
@@ -253,8 +259,11 @@ def process(args, prj, sample):
     # Call peaks
     pipe.timestamp("Calling peaks with MACS2")
     # make dir for output (macs fails if it does not exist)
-    if not os.path.exists(sample.dirs.peaks):
+    try:
         os.makedirs(sample.dirs.peaks)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
 
     cmd = tk.macs2CallPeaksATACSeq(
         treatmentBam=sample.filteredshifted,
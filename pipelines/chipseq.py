@@ -5,9 +5,11 @@ ChIP-seq pipeline
 """
 
 from argparse import ArgumentParser
+import errno
 import os
 import sys
 from . import toolkit as tk
+from .models import Paths
 import cPickle as pickle
 from pypiper import Pypiper
 
@@ -34,14 +36,19 @@ def main():
     samplePickle = args.samplePickle
 
     # Read in objects
-    prj, sample, args = pickle.load(open(samplePickle, "rb"))
+    with open(samplePickle, "rb", 1024 * 1024) as handle:
+        prj, sample, args = pickle.load(handle)
 
     # Start main function
     process(args, prj, sample)
 
     # Remove pickle
     if not args.dry_run:
-        os.system("rm %s" % samplePickle)
+        try:
+            os.unlink(samplePickle)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
     # Exit
     print("Finished and exiting.")
@@ -73,271 +80,255 @@ def process(args, prj, sample):
     # Start Pypiper object
     pipe = Pypiper("pipe", sample.dirs.sampleRoot, args=args)
 
+    # Bind sample attributes used throughout the pipeline
+    paired = sample.paired
+    tagmented = sample.tagmented
+    genome = sample.genome
+    cpus = args.cpus
+
+    # Resolve the sample's genome annotations once
+    annotations = prj.config["annotations"]
+    genomeFiles = Paths()
+    genomeFiles.genomeIndex = annotations["genomes"][genome]
+    genomeFiles.chrSizes = annotations["chrsizes"][genome]
+    genomeFiles.genomeWindows = annotations["genomewindows"][genome]
+
+    # Resolve input/output file names for the read type once
+    fastqs = tk.getFastqFiles(sample)
+    fastq1, fastq2, fastqUnpaired, trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired = fastqs
+
+    # Pick the trimmer, used for either read type
+    try:
+        trim, streamTrim = _TRIMMERS[args.trimmer]
+    except KeyError:
+        raise ValueError("Unknown trimmer: %s" % args.trimmer)
+
     # Merge Bam files if more than one technical replicate
-    if type(sample.unmappedBam) == list:
+    # (paired-end replicates are merged straight into fastq format further down)
+    if isinstance(sample.unmappedBam, (list, tuple)) and not paired:
         pipe.timestamp("Merging bam files from replicates")
         cmd = tk.mergeBams(
             inputBams=sample.unmappedBam,  # this is a list of sample paths
             outputBam=sample.unmapped
         )
-        pipe.call_lock(cmd, sample.unmapped, shell=True)
+        pipe.call_lock(cmd, sample.unmapped, shell=False)
         sample.unmappedBam = sample.unmapped
 
     # Fastqc
-    pipe.timestamp("Measuring sample quality with Fastqc")
-    cmd = tk.fastqc(
-        inputBam=sample.unmappedBam,
-        outputDir=sample.dirs.sampleRoot,
-        sampleName=sample.name
-    )
-    pipe.call_lock(cmd, os.path.join(sample.dirs.sampleRoot, sample.name + "_fastqc.zip"), shell=True)
-
-    # Convert bam to fastq
-    pipe.timestamp("Converting to Fastq format")
-    cmd = tk.bam2fastq(
-        inputBam=sample.unmappedBam,
-        outputFastq=sample.fastq1 if sample.paired else sample.fastq,
-        outputFastq2=sample.fastq2 if sample.paired else None,
-        unpairedFastq=sample.fastqUnpaired if sample.paired else None
-    )
-    pipe.call_lock(cmd, sample.fastq1 if sample.paired else sample.fastq, shell=True)
-    if not sample.paired:
-        pipe.clean_add(sample.fastq, conditional=True)
-    if sample.paired:
-        pipe.clean_add(sample.fastq1, conditional=True)
-        pipe.clean_add(sample.fastq2, conditional=True)
-        pipe.clean_add(sample.fastqUnpaired, conditional=True)
-
-    # Trim reads
-    pipe.timestamp("Trimming adapters from sample")
-    if args.trimmer == "trimmomatic":
-        cmd = tk.trimmomatic(
-            inputFastq1=sample.fastq1 if sample.paired else sample.fastq,
-            inputFastq2=sample.fastq2 if sample.paired else None,
-            outputFastq1=sample.trimmed1 if sample.paired else sample.trimmed,
-            outputFastq1unpaired=sample.trimmed1Unpaired if sample.paired else None,
-            outputFastq2=sample.trimmed2 if sample.paired else None,
-            outputFastq2unpaired=sample.trimmed2Unpaired if sample.paired else None,
-            cpus=args.cpus,
-            adapters=prj.config["adapters"],
-            log=sample.trimlog
+    # (paired-end replicates have no merged bam, their fastq files are checked further down)
+    if not isinstance(sample.unmappedBam, (list, tuple)):
+        pipe.timestamp("Measuring sample quality with Fastqc")
+        cmd = tk.fastqc(
+            inputBam=sample.unmappedBam,
+            outputDir=sample.dirs.sampleRoot,
+            sampleName=sample.name
         )
-        pipe.call_lock(cmd, sample.trimmed1 if sample.paired else sample.trimmed, shell=True)
-        if not sample.paired:
-            pipe.clean_add(sample.trimmed, conditional=True)
-        else:
-            pipe.clean_add(sample.trimmed1, conditional=True)
-            pipe.clean_add(sample.trimmed1Unpaired, conditional=True)
-            pipe.clean_add(sample.trimmed2, conditional=True)
-            pipe.clean_add(sample.trimmed2Unpaired, conditional=True)
-
-    elif args.trimmer == "skewer":
-        cmd = tk.skewer(
-            inputFastq1=sample.fastq1 if sample.paired else sample.fastq,
-            inputFastq2=sample.fastq2 if sample.paired else None,
-            outputPrefix=os.path.join(sample.dirs.unmapped, sample.name),
-            outputFastq1=sample.trimmed1 if sample.paired else sample.trimmed,
-            outputFastq2=sample.trimmed2 if sample.paired else None,
-            trimLog=sample.trimlog,
-            cpus=args.cpus,
-            adapters=prj.config["adapters"]
+        pipe.call_lock(cmd, os.path.join(sample.dirs.sampleRoot, sample.name + "_fastqc.zip"), shell=False)
+
+    if not paired:
+        # Convert to fastq, trim and map single-end reads in one pipe,
+        # so the intermediate fastq files are never written to disk
+        # (the trimmer and Bowtie2 run at the same time, so they share the cpus)
+        pipe.timestamp("Converting, trimming and mapping reads with Bowtie2")
+        trimCpus = max(1, cpus // 4)
+        cmd = tk.streamAlign(
+            inputBam=sample.unmappedBam,
+            outputBam=sample.mapped,
+            trimCmds=streamTrim(prj, sample, trimCpus),
+            log=sample.alnRates,
+            metrics=sample.alnMetrics,
+            genomeIndex=genomeFiles.genomeIndex,
+            maxInsert=args.maxinsert,
+            cpus=min(max(1, cpus - trimCpus), tk.BOWTIE2_MAX_THREADS)
         )
-        pipe.call_lock(cmd, sample.trimmed1 if sample.paired else sample.trimmed, shell=True)
-        if not sample.paired:
-            pipe.clean_add(sample.trimmed, conditional=True)
+        pipe.call_lock(cmd, sample.mapped, shell=True)
+        pipe.clean_add(sample.mapped, conditional=True)
+    else:
+        # Convert bam to fastq
+        # if more than one technical replicate, merge bams straight into fastq
+        if isinstance(sample.unmappedBam, (list, tuple)):
+            pipe.timestamp("Merging bam files from replicates into Fastq format")
+            cmd = tk.mergeToFastq(
+                inputBams=sample.unmappedBam,  # this is a list of sample paths
+                outputFastq=fastq1,
+                outputFastq2=fastq2,
+                unpairedFastq=fastqUnpaired
+            )
         else:
-            pipe.clean_add(sample.trimmed1, conditional=True)
-            pipe.clean_add(sample.trimmed2, conditional=True)
-
-    # Map
-    pipe.timestamp("Mapping reads with Bowtie2")
-    cmd = tk.bowtie2Map(
-        inputFastq1=sample.trimmed1 if sample.paired else sample.trimmed,
-        inputFastq2=sample.trimmed2 if sample.paired else None,
-        outputBam=sample.mapped,
-        log=sample.alnRates,
-        metrics=sample.alnMetrics,
-        genomeIndex=prj.config["annotations"]["genomes"][sample.genome],
-        maxInsert=args.maxinsert,
-        cpus=args.cpus
-    )
-    pipe.call_lock(cmd, sample.mapped, shell=True)
-    pipe.clean_add(sample.mapped, conditional=True)
+            pipe.timestamp("Converting to Fastq format")
+            cmd = tk.bam2fastq(
+                inputBam=sample.unmappedBam,
+                outputFastq=fastq1,
+                outputFastq2=fastq2,
+                unpairedFastq=fastqUnpaired
+            )
+        pipe.call_lock(cmd, fastq1, shell=True)
+        tk.cleanAddAll(pipe, [fastq1, fastq2, fastqUnpaired])
+
+        # Fastqc
+        # replicates merged straight into fastq have no bam file, so check both read files instead
+        if isinstance(sample.unmappedBam, (list, tuple)):
+            pipe.timestamp("Measuring sample quality with Fastqc")
+            for fastq, name in [(fastq1, sample.name + ".1"), (fastq2, sample.name + ".2")]:
+                cmd = tk.fastqc(
+                    inputBam=fastq,
+                    outputDir=sample.dirs.sampleRoot,
+                    sampleName=name
+                )
+                pipe.call_lock(cmd, os.path.join(sample.dirs.sampleRoot, name + "_fastqc.zip"), shell=False)
+
+        # Trim reads
+        pipe.timestamp("Trimming adapters from sample")
+        trim(pipe, prj, sample, args, fastqs)
+
+        # Map
+        pipe.timestamp("Mapping reads with Bowtie2")
+        cmd = tk.bowtie2Map(
+            inputFastq1=trimmed1,
+            inputFastq2=trimmed2,
+            outputBam=sample.mapped,
+            log=sample.alnRates,
+            metrics=sample.alnMetrics,
+            genomeIndex=genomeFiles.genomeIndex,
+            maxInsert=args.maxinsert,
+            cpus=min(cpus, tk.BOWTIE2_MAX_THREADS)
+        )
+        pipe.call_lock(cmd, sample.mapped, shell=True)
+        pipe.clean_add(sample.mapped, conditional=True)
 
     # Filter reads
-    pipe.timestamp("Filtering reads for quality")
-    cmd = tk.filterReads(
+    # the filtered bam comes out coordinate-sorted and indexed, ready for all
+    # downstream steps reading it
+    pipe.timestamp("Filtering, sorting and indexing reads")
+    cmd = tk.filterAndSortIndex(
         inputBam=sample.mapped,
         outputBam=sample.filtered,
         metricsFile=sample.dupsMetrics,
-        paired=sample.paired,
-        cpus=args.cpus,
+        paired=paired,
+        cpus=cpus,
         Q=args.quality
     )
     pipe.call_lock(cmd, sample.filtered, shell=True)
 
     # Shift reads
-    if sample.tagmented:
+    if tagmented:
         pipe.timestamp("Shifting reads of tagmented sample")
         cmd = tk.shiftReads(
             inputBam=sample.filtered,
-            genome=sample.genome,
+            genome=genome,
             outputBam=sample.filteredshifted
         )
         pipe.call_lock(cmd, sample.filteredshifted, shell=True)
 
     # Index bams
+    # these are independent of each other, so index them concurrently
     pipe.timestamp("Indexing bamfiles with samtools")
-    cmd = tk.indexBam(inputBam=sample.mapped)
-    pipe.call_lock(cmd, sample.mapped + ".bai", shell=True)
-    cmd = tk.indexBam(inputBam=sample.filtered)
-    pipe.call_lock(cmd, sample.filtered + ".bai", shell=True)
-    if sample.tagmented:
-        cmd = tk.indexBam(inputBam=sample.filteredshifted)
-        pipe.call_lock(cmd, sample.filteredshifted + ".bai", shell=True)
-
-    # Make tracks
+    bams = [sample.mapped]
+    if tagmented:
+        bams.append(sample.filteredshifted)
+    tk.callLockParallel(pipe, [
+        dict(cmd=tk.indexBam(inputBam=bam), target=bam + ".bai") for bam in bams
+    ], lock_name=sample.name + "indexBams")
+
+    # Make tracks, count coverage genome-wide and calculate NSC, RSC
+    # these only read the filtered bam and write separate outputs, so run them concurrently
     # right now tracks are only made for bams without duplicates
-    pipe.timestamp("Making bigWig tracks from bam file")
-    cmd = tk.bamToBigWig(
-        inputBam=sample.filtered,
-        outputBigWig=sample.bigwig,
-        genomeSizes=prj.config["annotations"]["chrsizes"][sample.genome],
-        genome=sample.genome,
-        tagmented=False,  # by default tracks are made for full extended reads
-        normalize=True
-    )
-    pipe.call_lock(cmd, sample.bigwig, shell=True)
+    pipe.timestamp("Making bigWig tracks, calculating genome-wide coverage and assessing signal/noise in sample")
+    tk.callLockParallel(pipe, [
+        dict(
+            cmd=tk.bamToBigWig(
+                inputBam=sample.filtered,
+                outputBigWig=sample.bigwig,
+                genomeSizes=genomeFiles.chrSizes,
+                genome=genome,
+                tagmented=False,  # by default tracks are made for full extended reads
+                normalize=True
+            ),
+            target=sample.bigwig
+        ),
+        dict(
+            cmd=tk.genomeWideCoverage(
+                inputBam=sample.filtered,
+                genomeWindows=genomeFiles.genomeWindows,
+                output=sample.coverage
+            ),
+            target=sample.coverage
+        ),
+        dict(
+            cmd=tk.peakTools(
+                inputBam=sample.filtered,
+                output=sample.qc,
+                plot=sample.qcPlot,
+                cpus=cpus
+            ),
+            target=sample.qcPlot, nofail=True
+        )
+    ], lock_name=sample.name + "tracksAndQC")
     cmd = tk.addTrackToHub(
         sampleName=sample.name,
         trackURL=sample.trackURL,
-        trackHub=os.path.join(prj.dirs.html, "trackHub_{0}.txt".format(sample.genome)),
+        trackHub=os.path.join(prj.dirs.html, "trackHub_{0}.txt".format(genome)),
         colour=sample.trackColour
     )
     pipe.call_lock(cmd, lock_name=sample.name + "addToTrackHub", shell=True)
     tk.linkToTrackHub(
-        trackHubURL="/".join([prj.config["url"], prj.name, "trackHub_{0}.txt".format(sample.genome)]),
-        fileName=os.path.join(prj.dirs.root, "ucsc_tracks_{0}.html".format(sample.genome)),
-        genome=sample.genome
+        trackHubURL="/".join([prj.config["url"], prj.name, "trackHub_{0}.txt".format(genome)]),
+        fileName=os.path.join(prj.dirs.root, "ucsc_tracks_{0}.html".format(genome)),
+        genome=genome
     )
 
-    # Count coverage genome-wide
-    pipe.timestamp("Calculating genome-wide coverage")
-    cmd = tk.genomeWideCoverage(
-        inputBam=sample.filtered,
-        genomeWindows=prj.config["annotations"]["genomewindows"][sample.genome],
-        output=sample.coverage
-    )
-    pipe.call_lock(cmd, sample.coverage, shell=True)
-
-    # Calculate NSC, RSC
-    pipe.timestamp("Assessing signal/noise in sample")
-    cmd = tk.peakTools(
-        inputBam=sample.filtered,
-        output=sample.qc,
-        plot=sample.qcPlot,
-        cpus=args.cpus
-    )
-    pipe.call_lock(cmd, sample.qcPlot, shell=True, nofail=True)
-
     # If sample does not have "ctrl" attribute, finish processing it.
     if not hasattr(sample, "ctrl"):
         print("Finished processing sample %s." % sample.name)
         return
 
-    if args.peak_caller == "macs2":
-        pipe.timestamp("Calling peaks with MACS2")
-        # make dir for output (macs fails if it does not exist)
-        if not os.path.exists(sample.dirs.peaks):
-            os.makedirs(sample.dirs.peaks)
-
-        # For point-source factors use default settings
-        # For broad factors use broad settings
-        cmd = tk.macs2CallPeaks(
-            treatmentBam=sample.filtered,
-            controlBam=sample.ctrl.filtered,
-            outputDir=sample.dirs.peaks,
-            sampleName=sample.name,
-            genome=sample.genome,
-            broad=True if sample.broad else False
-        )
-        pipe.call_lock(cmd, sample.peaks, shell=True)
+    # Annotations only needed for samples with a control
+    genomeFiles.tss = annotations["tss"][genome]
+    genomeFiles.peakWindowWidth = prj.config["options"]["peakwindowwidth"]
 
-        pipe.timestamp("Ploting MACS2 model")
-        cmd = tk.macs2PlotModel(
-            sampleName=sample.name,
-            outputDir=os.path.join(sample.dirs.peaks, sample.name)
-        )
-        pipe.call_lock(cmd, os.path.join(sample.dirs.peaks, sample.name, sample.name + "_model.pdf"), shell=True)
-    elif args.peak_caller == "spp":
-        pipe.timestamp("Calling peaks with spp")
-        # For point-source factors use default settings
-        # For broad factors use broad settings
-        cmd = tk.sppCallPeaks(
-            treatmentBam=sample.filtered,
-            controlBam=sample.ctrl.filtered,
-            treatmentName=sample.name,
-            controlName=sample.ctrl.sampleName,
-            outputDir=os.path.join(sample.dirs.peaks, sample.name),
-            broad=True if sample.broad else False,
-            cpus=args.cpus
-        )
-        pipe.call_lock(cmd, sample.peaks, shell=True)
-    elif args.peak_caller == "zinba":
-        raise NotImplementedError("Calling peaks with Zinba is not yet implemented.")
-        # pipe.timestamp("Calling peaks with Zinba")
-        # cmd = tk.bamToBed(
-        #     inputBam=sample.filtered,
-        #     outputBed=os.path.join(sample.dirs.peaks, sample.name + ".bed"),
-        # )
-        # pipe.call_lock(cmd, os.path.join(sample.dirs.peaks, sample.name + ".bed"), shell=True)
-        # cmd = tk.bamToBed(
-        #     inputBam=sample.ctrl.filtered,
-        #     outputBed=os.path.join(sample.dirs.peaks, control.sampleName + ".bed"),
-        # )
-        # pipe.call_lock(cmd, os.path.join(sample.dirs.peaks, control.sampleName + ".bed"), shell=True)
-        # cmd = tk.zinbaCallPeaks(
-        #     treatmentBed=os.path.join(sample.dirs.peaks, sample.name + ".bed"),
-        #     controlBed=os.path.join(sample.dirs.peaks, control.sampleName + ".bed"),
-        #     tagmented=sample.tagmented,
-        #     cpus=args.cpus
-        # )
-        # pipe.call_lock(cmd, shell=True)
+    try:
+        callPeaks = _PEAK_CALLERS[args.peak_caller]
+    except KeyError:
+        raise ValueError("Unknown peak caller: %s" % args.peak_caller)
+    callPeaks(pipe, prj, sample, args)
 
     # Find motifs
     pipe.timestamp("Finding motifs")
+    # top motif found by HOMER for the sample itself and for its co-binders
+    motifFile = os.path.join(sample.motifsDir, "homerResults", "motif1.motif")
+    cobindersMotifFile = os.path.join(sample.motifsDir + "_cobinders", "homerResults", "motif1.motif")
     if not sample.histone:
         # For TFs, find the "self" motif
         cmd = tk.homerFindMotifs(
             peakFile=sample.peaks,
-            genome=sample.genome,
+            genome=genome,
             outputDir=sample.motifsDir,
             size="50",
             length="8,10,12,14,16",
             n_motifs=8
         )
-        pipe.call_lock(cmd, os.path.join(sample.motifsDir, "homerResults", "motif1.motif"), shell=True)
+        pipe.call_lock(cmd, motifFile, shell=False)
         # For TFs, find co-binding motifs (broader region)
         cmd = tk.homerFindMotifs(
             peakFile=sample.peaks,
-            genome=sample.genome,
+            genome=genome,
             outputDir=sample.motifsDir + "_cobinders",
             size="200",
             length="8,10,12,14,16",
             n_motifs=12
         )
-        pipe.call_lock(cmd, os.path.join(sample.motifsDir + "_cobinders", "homerResults", "motif1.motif"), shell=True)
+        pipe.call_lock(cmd, cobindersMotifFile, shell=False)
     else:
         # For histones, use a broader region to find motifs
         cmd = tk.homerFindMotifs(
             peakFile=sample.peaks,
-            genome=sample.genome,
+            genome=genome,
             outputDir=sample.motifsDir,
             size="1000",
             length="8,10,12,14,16",
             n_motifs=20
         )
-        pipe.call_lock(cmd, os.path.join(sample.motifsDir, "homerResults", "motif1.motif"), shell=True)
+        pipe.call_lock(cmd, motifFile, shell=False)
 
     # Center peaks on motifs
     pipe.timestamp("Centering peak in motifs")
@@ -347,9 +338,9 @@ def process(args, prj, sample):
     # for that would imply taht option would be required when selecting this stage
     cmd = tk.centerPeaksOnMotifs(
         peakFile=sample.peaks,
-        genome=sample.genome,
-        windowWidth=prj.config["options"]["peakwindowwidth"],
-        motifFile=os.path.join(sample.motifsDir, "homerResults", "motif1.motif"),
+        genome=genome,
+        windowWidth=genomeFiles.peakWindowWidth,
+        motifFile=motifFile,
         outputBed=sample.peaksMotifCentered
     )
     pipe.call_lock(cmd, sample.peaksMotifCentered, shell=True)
@@ -362,53 +353,216 @@ def process(args, prj, sample):
     # for that would imply taht option would be required when selecting this stage
     cmd = tk.AnnotatePeaks(
         peakFile=sample.peaks,
-        genome=sample.genome,
-        motifFile=os.path.join(sample.motifsDir, "homerResults", "motif1.motif"),
+        genome=genome,
+        motifFile=motifFile,
         outputBed=sample.peaksMotifAnnotated
     )
     pipe.call_lock(cmd, sample.peaksMotifAnnotated, shell=True)
 
-    # Plot enrichment at peaks centered on motifs
-    pipe.timestamp("Ploting enrichment at peaks centered on motifs")
-    cmd = tk.peakAnalysis(
-        inputBam=sample.filtered,
-        peakFile=sample.peaksMotifCentered,
-        plotsDir=os.path.join(prj.dirs.results, 'plots'),
-        windowWidth=prj.config["options"]["peakwindowwidth"],
-        fragmentsize=1 if sample.tagmented else sample.readLength,
-        genome=sample.genome,
-        n_clusters=5,
-        strand_specific=True,
-        duplicates=True
+    # Plot enrichment at peaks centered on motifs and around TSSs,
+    # and calculate fraction of reads in peaks (FRiP)
+    # these are independent of each other, so run them concurrently
+    pipe.timestamp("Ploting enrichment at peaks centered on motifs and around TSSs, calculating FRiP")
+    tk.callLockParallel(pipe, [
+        dict(
+            cmd=tk.peakAnalysis(
+                inputBam=sample.filtered,
+                peakFile=sample.peaksMotifCentered,
+                plotsDir=os.path.join(prj.dirs.results, 'plots'),
+                windowWidth=genomeFiles.peakWindowWidth,
+                fragmentsize=1 if tagmented else sample.readLength,
+                genome=genome,
+                n_clusters=5,
+                strand_specific=True,
+                duplicates=True
+            ),
+            nofail=True
+        ),
+        dict(
+            cmd=tk.tssAnalysis(
+                inputBam=sample.filtered,
+                tssFile=genomeFiles.tss,
+                plotsDir=os.path.join(prj.dirs.results, 'plots'),
+                windowWidth=genomeFiles.peakWindowWidth,
+                fragmentsize=1 if tagmented else sample.readLength,
+                genome=genome,
+                n_clusters=5,
+                strand_specific=True,
+                duplicates=True
+            ),
+            nofail=True
+        ),
+        dict(
+            cmd=tk.calculateFRiP(
+                inputBam=sample.filtered,
+                inputBed=sample.peaks,
+                output=sample.frip
+            ),
+            target=sample.frip
+        )
+    ], lock_name=sample.name + "peakAnalyses")
+
+    pipe.stop_pipeline()
+    print("Finished processing sample %s." % sample.name)
+
+
+def _run_trimmomatic(pipe, prj, sample, args, fastqs):
+    """
+    Trims adapters from the sample's fastq files, as returned by `tk.getFastqFiles`, with Trimmomatic.
+    """
+    fastq1, fastq2, fastqUnpaired, trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired = fastqs
+
+    cmd = tk.trimmomatic(
+        inputFastq1=fastq1,
+        inputFastq2=fastq2,
+        outputFastq1=trimmed1,
+        outputFastq1unpaired=trimmed1Unpaired,
+        outputFastq2=trimmed2,
+        outputFastq2unpaired=trimmed2Unpaired,
+        cpus=args.cpus,
+        adapters=prj.config["adapters"],
+        log=sample.trimlog
+    )
+    pipe.call_lock(cmd, trimmed1, shell=True)
+    tk.cleanAddAll(pipe, [trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired])
+
+
+def _run_skewer(pipe, prj, sample, args, fastqs):
+    """
+    Trims adapters from the sample's fastq files, as returned by `tk.getFastqFiles`, with Skewer.
+    """
+    fastq1, fastq2, fastqUnpaired, trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired = fastqs
+
+    cmd = tk.skewer(
+        inputFastq1=fastq1,
+        inputFastq2=fastq2,
+        outputPrefix=os.path.join(sample.dirs.unmapped, sample.name),
+        outputFastq1=trimmed1,
+        outputFastq2=trimmed2,
+        trimLog=sample.trimlog,
+        cpus=args.cpus,
+        adapters=prj.config["adapters"]
+    )
+    pipe.call_lock(cmd, trimmed1, shell=True)
+    tk.cleanAddAll(pipe, [trimmed1, trimmed2])
+
+
+def _stream_trimmomatic(prj, sample, cpus):
+    """
+    Returns the Trimmomatic commands trimming single-end reads from stdin to stdout, for `tk.streamAlign`.
+    """
+    return [tk.trimmomatic(
+        inputFastq1="/dev/stdin",
+        outputFastq1="/dev/stdout",
+        cpus=cpus,
+        adapters=prj.config["adapters"],
+        log=sample.trimlog
+    )]
+
+
+def _stream_skewer(prj, sample, cpus):
+    """
+    Returns the Skewer commands trimming single-end reads from stdin to stdout, for `tk.streamAlign`.
+    """
+    return tk.skewer(
+        inputFastq1="-",
+        outputPrefix=os.path.join(sample.dirs.unmapped, sample.name),
+        outputFastq1=None,
+        trimLog=sample.trimlog,
+        cpus=cpus,
+        adapters=prj.config["adapters"],
+        stdout=True
     )
-    pipe.call_lock(cmd, shell=True, nofail=True)
-
-    # Plot enrichment around TSSs
-    pipe.timestamp("Ploting enrichment around TSSs")
-    cmd = tk.tssAnalysis(
-        inputBam=sample.filtered,
-        tssFile=prj.config["annotations"]["tss"][sample.genome],
-        plotsDir=os.path.join(prj.dirs.results, 'plots'),
-        windowWidth=prj.config["options"]["peakwindowwidth"],
-        fragmentsize=1 if sample.tagmented else sample.readLength,
+
+
+def _run_macs2(pipe, prj, sample, args):
+    """
+    Calls peaks on the sample against its control with MACS2 and plots the MACS2 model.
+    """
+    pipe.timestamp("Calling peaks with MACS2")
+    # make dir for output (macs fails if it does not exist)
+    try:
+        os.makedirs(sample.dirs.peaks)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+    # For point-source factors use default settings
+    # For broad factors use broad settings
+    cmd = tk.macs2CallPeaks(
+        treatmentBam=sample.filtered,
+        controlBam=sample.ctrl.filtered,
+        outputDir=sample.dirs.peaks,
+        sampleName=sample.name,
         genome=sample.genome,
-        n_clusters=5,
-        strand_specific=True,
-        duplicates=True
+        broad=True if sample.broad else False
     )
-    pipe.call_lock(cmd, shell=True, nofail=True)
-
-    # Calculate fraction of reads in peaks (FRiP)
-    pipe.timestamp("Calculating fraction of reads in peaks (FRiP)")
-    cmd = tk.calculateFRiP(
-        inputBam=sample.filtered,
-        inputBed=sample.peaks,
-        output=sample.frip
+    pipe.call_lock(cmd, sample.peaks, shell=False)
+
+    pipe.timestamp("Ploting MACS2 model")
+    cmd = tk.macs2PlotModel(
+        sampleName=sample.name,
+        outputDir=os.path.join(sample.dirs.peaks, sample.name)
     )
-    pipe.call_lock(cmd, sample.frip, shell=True)
+    pipe.call_lock(cmd, os.path.join(sample.dirs.peaks, sample.name, sample.name + "_model.pdf"), shell=False)
 
-    pipe.stop_pipeline()
-    print("Finished processing sample %s." % sample.name)
+
+def _run_spp(pipe, prj, sample, args):
+    """
+    Calls peaks on the sample against its control with spp.
+    """
+    pipe.timestamp("Calling peaks with spp")
+    # For point-source factors use default settings
+    # For broad factors use broad settings
+    cmd = tk.sppCallPeaks(
+        treatmentBam=sample.filtered,
+        controlBam=sample.ctrl.filtered,
+        treatmentName=sample.name,
+        controlName=sample.ctrl.sampleName,
+        outputDir=os.path.join(sample.dirs.peaks, sample.name),
+        broad=True if sample.broad else False,
+        cpus=args.cpus
+    )
+    pipe.call_lock(cmd, sample.peaks, shell=True)
+
+
+def _run_zinba(pipe, prj, sample, args):
+    """
+    Calls peaks on the sample against its control with Zinba.
+    """
+    raise NotImplementedError("Calling peaks with Zinba is not yet implemented.")
+    # pipe.timestamp("Calling peaks with Zinba")
+    # cmd = tk.bamToBed(
+    #     inputBam=sample.filtered,
+    #     outputBed=os.path.join(sample.dirs.peaks, sample.name + ".bed"),
+    # )
+    # pipe.call_lock(cmd, os.path.join(sample.dirs.peaks, sample.name + ".bed"), shell=True)
+    # cmd = tk.bamToBed(
+    #     inputBam=sample.ctrl.filtered,
+    #     outputBed=os.path.join(sample.dirs.peaks, control.sampleName + ".bed"),
+    # )
+    # pipe.call_lock(cmd, os.path.join(sample.dirs.peaks, control.sampleName + ".bed"), shell=True)
+    # cmd = tk.zinbaCallPeaks(
+    #     treatmentBed=os.path.join(sample.dirs.peaks, sample.name + ".bed"),
+    #     controlBed=os.path.join(sample.dirs.peaks, control.sampleName + ".bed"),
+    #     tagmented=sample.tagmented,
+    #     cpus=args.cpus
+    # )
+    # pipe.call_lock(cmd, shell=True)
+
+
+# Trimming and peak calling steps, by the name given in args.trimmer and args.peak_caller
+# Each trimmer writes trimmed paired-end fastq files, or builds the commands
+# trimming single-end reads streamed through `tk.streamAlign`
+_TRIMMERS = {
+    "trimmomatic": (_run_trimmomatic, _stream_trimmomatic),
+    "skewer": (_run_skewer, _stream_skewer)
+}
+_PEAK_CALLERS = {
+    "macs2": _run_macs2,
+    "spp": _run_spp,
+    "zinba": _run_zinba
+}
 
 
 if __name__ == '__main__':
@@ -494,7 +494,7 @@ class Sample(object):
         from collections import Counter
 
         # for samples with multiple original bams, get only first
-        if type(self.unmappedBam) == list:
+        if isinstance(self.unmappedBam, (list, tuple)):
             bam = self.unmappedBam[0]
         else:
             bam = self.unmappedBam
@@ -149,7 +149,7 @@ def sample_loop(args, prj):
         job_name = "_".join([run_name, sample.name])
 
         # if unmappedBam is a list, add final "unmapped" attr to sample object
-        if type(sample.unmappedBam) is list:
+        if isinstance(sample.unmappedBam, (list, tuple)):
             sample.unmapped = os.path.join(sample.dirs.unmapped, sample.name + ".bam")
 
         # assemble command
@@ -181,7 +181,8 @@ def sample_loop(args, prj):
                     print("Provided control sample name does not exist or is ambiguous: %s" % sample.controlname)
 
         # save pickle with all objects (this time, 2nd element is a tuple!)
-        pickle.dump((prj, sample, args), open(sample_pickle, "wb"))
+        with open(sample_pickle, "wb") as handle:
+            pickle.dump((prj, sample, args), handle, protocol=pickle.HIGHEST_PROTOCOL)
 
         # Actual call to pipeline
         technique = sample.technique.upper()
@@ -5,9 +5,11 @@ Quant-seq pipeline
 """
 
 from argparse import ArgumentParser
+import errno
 import os
 import sys
 from . import toolkit as tk
+from .models import Paths
 import cPickle as pickle
 from pypiper import Pypiper
 
@@ -31,14 +33,19 @@ def main():
     samplePickle = args.samplePickle
 
     # Read in objects
-    prj, sample, args = pickle.load(open(args.samplePickle, "rb"))
+    with open(samplePickle, "rb", 1024 * 1024) as handle:
+        prj, sample, args = pickle.load(handle)
 
     # Start main function
     process(args, prj, sample)
 
     # Remove pickle
     if not args.dry_run:
-        os.system("rm %s" % samplePickle)
+        try:
+            os.unlink(samplePickle)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
 
     # Exit
     print("Finished and exiting.")
@@ -70,134 +77,134 @@ def process(args, prj, sample):
     # Start Pypiper object
     pipe = Pypiper("pipe", sample.dirs.sampleRoot, args=args)
 
-    # if more than one technical replicate, merge bams
-    if type(sample.unmappedBam) == list:
-        pipe.timestamp("Merging bam files from replicates")
-        cmd = tk.mergeBams(
+    # Bind sample attributes used throughout the pipeline
+    paired = sample.paired
+    genome = sample.genome
+    cpus = args.cpus
+
+    # Resolve the sample's genome annotations once
+    annotations = prj.config["annotations"]
+    genomeFiles = Paths()
+    genomeFiles.genomeIndex = annotations["genomes"][genome]
+    genomeFiles.transcriptome = annotations["transcriptomes"][genome]
+    genomeFiles.kallistoIndex = annotations["kallistoindex"][genome]
+    genomeFiles.erccIndex = annotations["genomes"]["ercc"]
+    genomeFiles.erccTranscriptome = annotations["transcriptomes"]["ercc"]
+
+    # Resolve input/output file names for the read type once
+    fastq1, fastq2, fastqUnpaired, trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired = tk.getFastqFiles(sample)
+
+    # Convert bam to fastq
+    # if more than one technical replicate, merge bams straight into fastq
+    if isinstance(sample.unmappedBam, (list, tuple)):
+        pipe.timestamp("Merging bam files from replicates into Fastq format")
+        cmd = tk.mergeToFastq(
             inputBams=sample.unmappedBam,  # this is a list of sample paths
-            outputBam=sample.unmapped
+            outputFastq=fastq1,
+            outputFastq2=fastq2,
+            unpairedFastq=fastqUnpaired
         )
-        pipe.call_lock(cmd, sample.unmapped, shell=True)
-        sample.unmappedBam = sample.unmapped
+    else:
+        pipe.timestamp("Converting to Fastq format")
+        cmd = tk.bam2fastq(
+            inputBam=sample.unmappedBam,
+            outputFastq=fastq1,
+            outputFastq2=fastq2,
+            unpairedFastq=fastqUnpaired
+        )
+    pipe.call_lock(cmd, fastq1, shell=True)
+    tk.cleanAddAll(pipe, [fastq1, fastq2, fastqUnpaired])
 
     # Fastqc
+    # replicates merged straight into fastq have no bam file, so check each read file instead
     pipe.timestamp("Measuring sample quality with Fastqc")
-    cmd = tk.fastqc(
-        inputBam=sample.unmappedBam,
-        outputDir=sample.dirs.sampleRoot,
-        sampleName=sample.name
-    )
-    pipe.call_lock(cmd, os.path.join(sample.dirs.sampleRoot, sample.name + "_fastqc.zip"), shell=True)
-
-    # Convert bam to fastq
-    pipe.timestamp("Converting to Fastq format")
-    cmd = tk.bam2fastq(
-        inputBam=sample.unmappedBam,
-        outputFastq=sample.fastq1 if sample.paired else sample.fastq,
-        outputFastq2=sample.fastq2 if sample.paired else None,
-        unpairedFastq=sample.fastqUnpaired if sample.paired else None
-    )
-    pipe.call_lock(cmd, sample.fastq1 if sample.paired else sample.fastq, shell=True)
-    if not sample.paired:
-        pipe.clean_add(sample.fastq, conditional=True)
-    if sample.paired:
-        pipe.clean_add(sample.fastq1, conditional=True)
-        pipe.clean_add(sample.fastq2, conditional=True)
-        pipe.clean_add(sample.fastqUnpaired, conditional=True)
+    if not isinstance(sample.unmappedBam, (list, tuple)):
+        reports = [(sample.unmappedBam, sample.name)]
+    elif paired:
+        reports = [(fastq1, sample.name + ".1"), (fastq2, sample.name + ".2")]
+    else:
+        reports = [(fastq1, sample.name)]
+    for inputFile, name in reports:
+        cmd = tk.fastqc(
+            inputBam=inputFile,
+            outputDir=sample.dirs.sampleRoot,
+            sampleName=name
+        )
+        pipe.call_lock(cmd, os.path.join(sample.dirs.sampleRoot, name + "_fastqc.zip"), shell=False)
 
     # Trim reads
     pipe.timestamp("Trimming adapters from sample")
     # Use of trimmomatic is enforced in this pipeline regardless of args.trimmer
     cmd = trimmomatic(
-        inputFastq1=sample.fastq1 if sample.paired else sample.fastq,
-        inputFastq2=sample.fastq2 if sample.paired else None,
-        outputFastq1=sample.trimmed1 if sample.paired else sample.trimmed,
-        outputFastq1unpaired=sample.trimmed1Unpaired if sample.paired else None,
-        outputFastq2=sample.trimmed2 if sample.paired else None,
-        outputFastq2unpaired=sample.trimmed2Unpaired if sample.paired else None,
-        cpus=args.cpus,
+        inputFastq1=fastq1,
+        inputFastq2=fastq2,
+        outputFastq1=trimmed1,
+        outputFastq1unpaired=trimmed1Unpaired,
+        outputFastq2=trimmed2,
+        outputFastq2unpaired=trimmed2Unpaired,
+        cpus=cpus,
         adapters=prj.config["adapters"],
         log=sample.trimlog
     )
-    pipe.call_lock(cmd, sample.trimmed1 if sample.paired else sample.trimmed, shell=True)
-    if not sample.paired:
-        pipe.clean_add(sample.trimmed, conditional=True)
-    else:
-        pipe.clean_add(sample.trimmed1, conditional=True)
-        pipe.clean_add(sample.trimmed1Unpaired, conditional=True)
-        pipe.clean_add(sample.trimmed2, conditional=True)
-        pipe.clean_add(sample.trimmed2Unpaired, conditional=True)
+    pipe.call_lock(cmd, trimmed1, shell=True)
+    tk.cleanAddAll(pipe, [trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired])
 
     # Map
-    pipe.timestamp("Mapping sample with Tophat")
-    cmd = tk.topHatMap(
-        inputFastq=sample.trimmed1 if sample.paired else sample.trimmed,
+    # Transcriptome and ERCC alignments are independent, so run them
+    # concurrently, each with half of the available cpus
+    pipe.timestamp("Mapping sample with Tophat and erccs with Bowtie2")
+    mapCmd = tk.topHatMap(
+        inputFastq=trimmed1,
         outDir=sample.dirs.mapped,
-        genome=prj.config["annotations"]["genomes"][sample.genome],
-        transcriptome=prj.config["annotations"]["transcriptomes"][sample.genome],
-        cpus=args.cpus
+        genome=genomeFiles.genomeIndex,
+        transcriptome=genomeFiles.transcriptome,
+        cpus=max(1, cpus // 2)
     )
-    pipe.call_lock(cmd, sample.mapped, shell=True)
-    pipe.clean_add(sample.mapped, conditional=True)
-
-    pipe.timestamp("Mapping erccs with Bowtie2")
-    cmd = tk.bowtie2Map(
-        inputFastq1=sample.trimmed1 if sample.paired else sample.trimmed,
-        inputFastq2=sample.trimmed1 if sample.paired else None,
+    erccCmd = tk.bowtie2Map(
+        inputFastq1=trimmed1,
+        inputFastq2=trimmed1 if paired else None,
         outputBam=sample.erccMapped,
         log=sample.erccAlnRates,
         metrics=sample.erccAlnMetrics,
-        genomeIndex=prj.config["annotations"]["genomes"]["ercc"],
+        genomeIndex=genomeFiles.erccIndex,
         maxInsert=args.maxinsert,
-        cpus=args.cpus
+        cpus=min(max(1, cpus // 2), tk.BOWTIE2_MAX_THREADS)
     )
-    pipe.call_lock(cmd, sample.erccMapped, shell=True)
-    pipe.clean_add(sample.erccMapped, conditional=True)
-
-    # Filter reads
-    pipe.timestamp("Filtering reads")
-    cmd = tk.filterReads(
+    tk.callLockParallel(pipe, [
+        dict(cmd=mapCmd, target=sample.mapped),
+        dict(cmd=erccCmd, target=sample.erccMapped)
+    ], lock_name=sample.name + "mapping")
+    tk.cleanAddAll(pipe, [sample.mapped, sample.erccMapped])
+
+    # Filter, sort and index reads
+    pipe.timestamp("Filtering, sorting and indexing reads")
+    cmd = tk.filterAndSortIndex(
         inputBam=sample.mapped,
         outputBam=sample.filtered,
         metricsFile=sample.dupsMetrics,
-        paired=sample.paired,
-        cpus=args.cpus,
+        paired=paired,
+        cpus=cpus,
         Q=args.quality
     )
     pipe.call_lock(cmd, sample.filtered, shell=True)
 
-    pipe.timestamp("Filtering ERCC reads")
-    cmd = tk.filterReads(
+    pipe.timestamp("Filtering, sorting and indexing ERCC reads")
+    cmd = tk.filterAndSortIndex(
         inputBam=sample.erccMapped,
         outputBam=sample.erccFiltered,
         metricsFile=sample.erccDupsMetrics,
-        paired=sample.paired,
-        cpus=args.cpus,
+        paired=paired,
+        cpus=cpus,
         Q=args.quality
     )
     pipe.call_lock(cmd, sample.erccFiltered, shell=True)
 
-    # Sort and index
-    pipe.timestamp("Sorting and indexing reads")
-    cmd = tk.sortIndexBam(
-        inputBam=sample.filtered,
-        outputBam=sample.filtered
-    )
-    pipe.call_lock(cmd, lock_name="sample.filtered", shell=True)
-
-    pipe.timestamp("Sorting and indexing ERCC reads")
-    cmd = tk.sortIndexBam(
-        inputBam=sample.erccFiltered,
-        outputBam=sample.erccFiltered
-    )
-    pipe.call_lock(cmd, lock_name="sample.erccFiltered", shell=True)
-
     # Quantify Transcripts
     # With HTseq-count from alignments
     pipe.timestamp("Quantify sample transcripts with htseq-count")
     cmd = tk.htSeqCount(
         inputBam=sample.filtered,
-        gtf=prj.config["annotations"]["transcriptomes"][sample.genome],
+        gtf=genomeFiles.transcriptome,
         output=sample.quant
     )
     pipe.call_lock(cmd, sample.quant, shell=True)
@@ -205,7 +212,7 @@ def process(args, prj, sample):
     pipe.timestamp("Quantify ERCC transcripts with htseq-count")
     cmd = tk.htSeqCount(
         inputBam=sample.erccFiltered,
-        gtf=prj.config["annotations"]["transcriptomes"]["ercc"],
+        gtf=genomeFiles.erccTranscriptome,
         output=sample.erccQuant
     )
     pipe.call_lock(cmd, sample.erccQuant, shell=True, nofail=True)
@@ -213,12 +220,12 @@ def process(args, prj, sample):
     # With kallisto from unmapped reads
     pipe.timestamp("Quantifying read counts with kallisto")
     cmd = tk.kallisto(
-        inputFastq=sample.trimmed1 if sample.paired else sample.trimmed,
-        inputFastq2=sample.trimmed1 if sample.paired else None,
+        inputFastq=trimmed1,
+        inputFastq2=trimmed1 if paired else None,
         outputDir=sample.dirs.quant,
         outputBam=sample.pseudomapped,
-        transcriptomeIndex=prj.config["annotations"]["kallistoindex"][sample.genome],
-        cpus=args.cpus
+        transcriptomeIndex=genomeFiles.kallistoIndex,
+        cpus=cpus
     )
     pipe.call_lock(cmd, sample.kallistoQuant, shell=True, nofail=True)
 
@@ -233,20 +240,58 @@ def trimmomatic(inputFastq1, outputFastq1, cpus, adapters, log,
     PE = False if inputFastq2 is None else True
     pe = "PE" if PE else "SE"
 
-    cmd = "java -Xmx4g -jar `which trimmomatic-0.32.jar`"
-    cmd += " {0} -threads {1} -trimlog {2} {3}".format(pe, cpus, log, inputFastq1)
+    outputs = [outputFastq1]
     if PE:
-        cmd += " {0}".format(inputFastq2)
-    cmd += " {0}".format(outputFastq1)
+        outputs += [outputFastq1unpaired, outputFastq2, outputFastq2unpaired]
+
+    # Trimmomatic's own gzip compression is single-threaded,
+    # so gzipped outputs are written to fifos and compressed with pigz.
+    # None of the pipeline's outputs are currently gzipped (the trimmed files are plain fastq),
+    # this only applies when a sample's trimmed file names end in ".gz"
+    fifos = dict((output, _pigzFifo(output)) for output in outputs if output.endswith(".gz"))
+
+    # Trimmomatic and the compressors run at the same time, so they share the cpus
+    trimCpus = max(1, cpus // 2) if len(fifos) > 0 else cpus
+
+    cmd = ["java -Xmx4g -jar `which trimmomatic-0.32.jar`"]
+    cmd += [pe, "-threads", str(trimCpus), "-trimlog", log, inputFastq1]
     if PE:
-        cmd += " {0} {1} {2}".format(outputFastq1unpaired, outputFastq2, outputFastq2unpaired)
-    cmd += " ILLUMINACLIP:{0}:1:40:15:8:true".format(adapters)
-    cmd += " HEADCROP:12"
-    cmd += " TRAILING:3"
-    cmd += " SLIDINGWINDOW:4:10"
-    cmd += " MINLEN:36"
-
-    return cmd
+        cmd.append(inputFastq2)
+    cmd += [fifos.get(output, output) for output in outputs]
+    cmd += [
+        "ILLUMINACLIP:{0}:1:40:15:8:true".format(adapters),
+        "HEADCROP:12",
+        "TRAILING:3",
+        "SLIDINGWINDOW:4:10",
+        "MINLEN:36"
+    ]
+    cmd = " ".join(cmd)
+
+    if len(fifos) == 0:
+        return cmd
+
+    pigzCpus = max(1, (cpus - trimCpus) // len(fifos))
+    fifoList = " ".join(fifos[output] for output in outputs if output in fifos)
+    pigz = " ".join(
+        "pigz -p {0} -c < {1} > {2} & pids=\"$pids $!\";".format(pigzCpus, fifos[output], output)
+        for output in outputs if output in fifos
+    )
+    # if Trimmomatic fails, compressors still blocked on opening their fifo are killed;
+    # every compressor is waited for and the fifos are removed whatever the outcome
+    return (
+        "rm -f {0}; mkfifo {0} || exit 1; pids=\"\"; {1} {2}; status=$?;"
+        " if [ $status -ne 0 ]; then kill $pids 2> /dev/null; fi;"
+        " for pid in $pids; do wait $pid || status=1; done; rm -f {0}; [ $status -eq 0 ]"
+    ).format(fifoList, pigz, cmd)
+
+
+def _pigzFifo(outputFile):
+    """
+    Returns the path of the fifo through which a gzipped output file is compressed by pigz.
+    """
+    import re
+
+    return re.sub("\.gz$", ".fifo", outputFile)
 
 
 if __name__ == '__main__':
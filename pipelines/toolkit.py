@@ -1,5 +1,8 @@
 #!/usr/bin/env python
 
+# Bowtie2 stops scaling (and may get slower) beyond this number of threads
+BOWTIE2_MAX_THREADS = 16
+
 
 def slurmHeader(jobName, output, queue="shortq", ntasks=1, time="10:00:00",
                 cpusPerTask=16, memPerCpu=2000, nodes=1, userMail=""):
@@ -75,6 +78,10 @@ def fastqc(inputBam, outputDir, sampleName):
 
     cmd1 = "fastqc --noextract --outdir {0} {1}".format(outputDir, inputBam)
 
+    # reports are already named after the sample if the input file is
+    if initial == sampleName:
+        return [cmd1]
+
     cmd2 = "mv {0}_fastqc.html {1}_fastqc.html".format(os.path.join(outputDir, initial), os.path.join(outputDir, sampleName))
 
     cmd3 = "mv {0}_fastqc.zip {1}_fastqc.zip".format(os.path.join(outputDir, initial), os.path.join(outputDir, sampleName))
@@ -93,6 +100,25 @@ def bam2fastq(inputBam, outputFastq, outputFastq2=None, unpairedFastq=None):
     return cmd
 
 
+def mergeToFastq(inputBams, outputFastq, outputFastq2=None, unpairedFastq=None):
+    """
+    Merges several unmapped bam files and converts them to fastq in one pipe,
+    without writing the merged bam file to disk.
+    The pipe runs under bash with pipefail, so a failure in any of its commands fails the step.
+    """
+    cmd = mergeBams(inputBams=inputBams, outputBam="/dev/stdout")
+    cmd += " COMPRESSION_LEVEL=0 |"
+    cmd += " " + bam2fastq(
+        inputBam="/dev/stdin",
+        outputFastq=outputFastq,
+        outputFastq2=outputFastq2,
+        unpairedFastq=unpairedFastq
+    )
+    cmd = "bash -o pipefail -c '{0}'".format(cmd.replace("'", "'\\''"))
+
+    return cmd
+
+
 def trimmomatic(inputFastq1, outputFastq1, cpus, adapters, log,
                 inputFastq2=None, outputFastq1unpaired=None,
                 outputFastq2=None, outputFastq2unpaired=None):
@@ -115,7 +141,7 @@ def trimmomatic(inputFastq1, outputFastq1, cpus, adapters, log,
     return cmd
 
 
-def skewer(inputFastq1, outputPrefix, outputFastq1, trimLog, cpus, adapters, inputFastq2=None, outputFastq2=None):
+def skewer(inputFastq1, outputPrefix, outputFastq1, trimLog, cpus, adapters, inputFastq2=None, outputFastq2=None, stdout=False):
 
     PE = False if inputFastq2 is None else True
     mode = "pe" if PE else "any"
@@ -128,6 +154,9 @@ def skewer(inputFastq1, outputPrefix, outputFastq1, trimLog, cpus, adapters, inp
     cmd1 += " -m {0}".format(mode)
     cmd1 += " -x {0}".format(adapters)
     cmd1 += " -o {0}".format(outputPrefix)
+    if stdout:
+        # trimmed reads are written to stdout, only the log goes to outputPrefix
+        cmd1 += " -1"
     cmd1 += " {0}".format(inputFastq1)
     if inputFastq2 is None:
         cmds.append(cmd1)
@@ -135,7 +164,10 @@ def skewer(inputFastq1, outputPrefix, outputFastq1, trimLog, cpus, adapters, inp
         cmd1 += " {0}".format(inputFastq2)
         cmds.append(cmd1)
 
-    if inputFastq2 is None:
+    if stdout:
+        # nothing to move besides the log
+        pass
+    elif inputFastq2 is None:
         cmd2 = "mv {0} {1}".format(outputPrefix + "-trimmed.fastq", outputFastq1)
         cmds.append(cmd2)
     else:
@@ -165,11 +197,35 @@ def bowtie2Map(inputFastq1, outputBam, log, metrics, genomeIndex, maxInsert, cpu
         cmd += " --maxins {0}".format(maxInsert)
         cmd += " -1 {0}".format(inputFastq1)
         cmd += " -2 {0}".format(inputFastq2)
-    cmd += " 2> {0} | samtools view -S -b - | samtools sort - {1}".format(log, outputBam)
+    # SAM is converted on the fly and handed uncompressed to sort, which writes the only file
+    cmd += " 2> {0} | samtools view -S -u - | samtools sort - {1}".format(log, outputBam)
 
     return cmd
 
 
+def streamAlign(inputBam, outputBam, trimCmds, log, metrics, genomeIndex, maxInsert, cpus):
+    """
+    Converts an unmapped single-end bam file to fastq, trims adapters and maps
+    the reads with Bowtie2 in a single pipe, without writing intermediate fastq files.
+    The pipe runs under bash with pipefail, so a failure in any of its commands fails the step.
+
+    :param trimCmds: Trimmer commands, the first reading fastq from stdin and writing
+        the trimmed reads to stdout; any others are run after the pipe.
+    :type trimCmds: list
+    :param cpus: Number of threads for Bowtie2.
+    :type cpus: int
+    """
+    cmd = bam2fastq(inputBam=inputBam, outputFastq="/dev/stdout")
+    cmd += " | " + trimCmds[0]
+    cmd += " | " + bowtie2Map(
+        inputFastq1="-", outputBam=outputBam, log=log, metrics=metrics,
+        genomeIndex=genomeIndex, maxInsert=maxInsert, cpus=cpus
+    )
+    cmd = "bash -o pipefail -c '{0}'".format(cmd.replace("'", "'\\''"))
+
+    return [cmd] + trimCmds[1:]
+
+
 def topHatMap(inputFastq, outDir, genome, transcriptome, cpus):
     # TODO:
     # Allow paired input
@@ -256,6 +312,18 @@ def filterReads(inputBam, outputBam, metricsFile, paired=False, cpus=16, Q=30):
     return [cmd1, cmd2, cmd3, cmd4]
 
 
+def filterAndSortIndex(inputBam, outputBam, metricsFile, paired=False, cpus=16, Q=30):
+    """
+    Remove duplicates, filter reads as `filterReads` and index the output.
+    The filtered reads are already coordinate-sorted on their way out,
+    so they are not read back and sorted a second time.
+    """
+    cmds = filterReads(inputBam=inputBam, outputBam=outputBam, metricsFile=metricsFile, paired=paired, cpus=cpus, Q=Q)
+    cmds.append(indexBam(inputBam=outputBam))
+
+    return cmds
+
+
 def shiftReads(inputBam, genome, outputBam):
     import re
 
@@ -740,6 +808,77 @@ def diffBind(inputCSV, jobName, plotsDir):
     return cmd
 
 
+def callLockParallel(pipe, calls, lock_name):
+    """
+    Runs independent pipeline steps concurrently as a single `pipe.call_lock` step,
+    backgrounding each in the shell so the Pypiper object only runs one command at a time.
+    Steps whose target already exists are skipped, as `pipe.call_lock` would do.
+    The combined step waits for every step and fails if any step not marked "nofail" failed.
+
+    :param pipe: Pypiper object of the running pipeline.
+    :type pipe: pypiper.Pypiper
+    :param calls: Dicts with each step's "cmd" (a command or a list of commands run in order),
+        and optionally its "target" file and "nofail" flag.
+    :type calls: list
+    :param lock_name: Name of the lock for the combined step.
+    :type lock_name: str
+    """
+    import os
+
+    jobs = list()
+    for call in calls:
+        if call.get("target") is not None and os.path.exists(call["target"]):
+            continue
+        cmd = call["cmd"]
+        if isinstance(cmd, (list, tuple)):
+            cmd = " && ".join(cmd)
+        if call.get("nofail", False):
+            cmd = "({0}) || true".format(cmd)
+        jobs.append("( {0} ) & pids=\"$pids $!\";".format(cmd))
+
+    if len(jobs) == 0:
+        return
+
+    cmd = "pids=\"\"; " + " ".join(jobs)
+    cmd += " status=0; for pid in $pids; do wait $pid || status=1; done; [ $status -eq 0 ]"
+
+    pipe.call_lock(cmd, lock_name=lock_name, shell=True)
+
+
+def cleanAddAll(pipe, files, conditional=True):
+    """
+    Registers several files for cleanup at the end of the pipeline with `pipe.clean_add`.
+    Files that are None (e.g. unused for the sample's read type) are skipped.
+
+    :param pipe: Pypiper object of the running pipeline.
+    :type pipe: pypiper.Pypiper
+    :param files: Paths of files to clean.
+    :type files: list
+    :param conditional: Only clean files if the pipeline finishes successfully.
+    :type conditional: bool
+    """
+    for fileName in files:
+        if fileName is not None:
+            pipe.clean_add(fileName, conditional=conditional)
+
+
+def getFastqFiles(sample):
+    """
+    Returns the fastq files used by the pipelines for the sample's read type, as a tuple of
+    (fastq1, fastq2, fastqUnpaired, trimmed1, trimmed1Unpaired, trimmed2, trimmed2Unpaired).
+    For single-end samples the first fastq and trimmed files are the only ones set.
+
+    :param sample: A Sample object with its file paths set.
+    :type sample: pipelines.Sample
+    """
+    if sample.paired:
+        return (
+            sample.fastq1, sample.fastq2, sample.fastqUnpaired,
+            sample.trimmed1, sample.trimmed1Unpaired, sample.trimmed2, sample.trimmed2Unpaired
+        )
+    return (sample.fastq, None, None, sample.trimmed, None, None, None)
+
+
 def getReadType(bamFile, n=10):
     """
     Gets the read type (single, paired) and length of bam file.